@@ -1,11 +1,34 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
-"""Export data from BigQuery to Yahoo!."""
+"""Export data from BigQuery to Yahoo!.
 
+Environment variables:
+    project_id, bq_dataset_id, start_date, end_date, bq_query
+        BigQuery query settings
+    send_beacon         'true' to request measurement urls (default: 'false')
+    low_memory_mode     'true' to stream rows in batches (default: 'false')
+    batch_size          rows per batch in low memory mode (default: 1000)
+    max_in_flight       rows sent concurrently (default: 1000)
+    max_connections     HTTP connections (default: 100)
+    request_timeout     seconds per request (default: 10)
+    timeout             seconds for the whole export, 0 for none (default: 0)
+
+Memory:
+    in low memory mode, only one batch of batch_size rows and up to
+    max_in_flight sends are held at a time, so memory does not grow with
+    the result size. With the default batch_size and max_in_flight, the
+    batching and send loop peaks under 8 MiB on dummy rows (tests/test.py).
+    This figure excludes the BigQuery client's current page and aiohttp
+    buffers. The default mode holds the whole result.
+"""
+
+import aiohttp
+import asyncio
 from google.cloud import bigquery
 from google.cloud.bigquery.job import QueryJob
 import os
 import sys
+import concurrent.futures
 import urllib.parse
 import urllib.request
 from urllib.request import urlopen
@@ -13,7 +36,6 @@ from google.cloud import error_reporting
 import google.cloud.logging
 from google.cloud.logging.handlers import CloudLoggingHandler
 import logging
-from time import sleep
 
 
 class CommonError(Exception):
@@ -21,18 +43,62 @@ class CommonError(Exception):
     pass
 
 
+class RowBatch(object):
+    """compact batch of BigQuery rows.
+
+    Only the columns needed to send beacons are kept, as parallel lists of
+    str references instead of per-row ``Row`` objects with field-name dicts.
+    ``segmentId`` values are interned, so every row of the same segment
+    shares one str object.
+    """
+    __slots__ = ('segment_ids', 'client_ids', 'idfas', 'adids')
+
+    def __init__(
+        self,
+        rows=(),
+    ):
+        """init."""
+        self.segment_ids = []
+        self.client_ids = []
+        self.idfas = []
+        self.adids = []
+        for row in rows:
+            self.append(row)
+
+    def append(
+        self,
+        row,
+    ):
+        """append a row."""
+        self.segment_ids.append(sys.intern(str(row.segmentId)))
+        self.client_ids.append(row.clientId)
+        self.idfas.append(row.idfa)
+        self.adids.append(row.adid)
+
+    def __len__(self) -> int:
+        """row count."""
+        return len(self.segment_ids)
+
+    def __iter__(self):
+        """iterate (segment_id, client_id, idfa, adid)."""
+        return zip(self.segment_ids, self.client_ids, self.idfas, self.adids)
+
+
 class ExportBqDataToY(object):
     """Export data from BigQuery to Yahoo!."""
     def __init__(
         self,
         bq_project_id: str,
         bq_dataset_id: str,
+        send_beacon: bool = False,
     ):
         """init."""
         self.bq_project_id = bq_project_id
         self.bq_dataset_id = bq_dataset_id
         self.bigquery_client = None
         self.bq_dataset = None
+        # request measurement urls only when send_beacon is True
+        self.send_beacon = send_beacon
         self.api_url_fmt = 'https://s.tgm.yahoo-net.jp/api?site=cdiLM0x&referrer=%s&%s=%s&flag=%s'
 
     def __connect_bq(func):
@@ -57,31 +123,120 @@ class ExportBqDataToY(object):
             job_config=job_config,
         )
 
-    def __get_data_from_bq(
-            self,
-            query: str,
-    ) -> list:
-        """get data from BigQuery."""
-        try:
-            # get
-            query_job = self.__bq_query(query)
-            # check job
-            if len(list(query_job)) == 0:
-                raise CommonError('no data in BigQuery.')
-        except Exception as e:
-            raise CommonError(e)
-        return query_job
-
     @__connect_bq
-    def get_data_from_bq(
+    def get_data_batches_from_bq(
         self,
         query: str,
-    ) -> list:
-        """get data from BigQuery."""
+        batch_size: int = None,
+    ):
+        """get data from BigQuery in RowBatch of batch_size rows.
+
+        Rows are fetched page by page and only one batch is held at a time,
+        so memory use is bounded by batch_size, not by the result size.
+        If batch_size is None, all rows are returned in one RowBatch.
+        """
+        if batch_size is not None and not batch_size > 0:
+            raise CommonError('batch_size must be positive: %s.' % (
+                batch_size,
+            ))
         try:
-            return self.__get_data_from_bq(query)
+            rows = self.__bq_query(query).result(page_size=batch_size)
         except Exception as e:
             raise CommonError(e)
+        return self.__make_batches(rows, batch_size)
+
+    def __make_batches(
+        self,
+        rows,
+        batch_size: int = None,
+    ):
+        """split rows into RowBatch of batch_size rows."""
+        row_count = 0
+        batch = RowBatch()
+        rows = iter(rows)
+        while True:
+            # get next row, fetching next page if needed
+            try:
+                row = next(rows, None)
+                if row is None:
+                    break
+                batch.append(row)
+            except Exception as e:
+                raise CommonError(e)
+            if batch_size is not None and len(batch) >= batch_size:
+                row_count += len(batch)
+                yield batch
+                batch = RowBatch()
+        row_count += len(batch)
+        # check data
+        if row_count == 0:
+            raise CommonError('no data in BigQuery.')
+        if len(batch) > 0:
+            yield batch
+
+    def __make_url_params(
+        self,
+        segment_id: str,
+        client_id: str,
+        idfa: str,
+        adid: str,
+    ) -> list:
+        """make url params of one row."""
+        url_params = []
+        if idfa != '':
+            # IDFA
+            url_params.append({
+                'referrer': 'idfa_referrer',
+                'key': 'idfa',
+                'value': idfa,
+                'flag': segment_id,
+            })
+        if adid != '':
+            # AAID
+            url_params.append({
+                'referrer': 'adid_referrer',
+                'key': 'adid',
+                'value': adid,
+                'flag': segment_id,
+            })
+        # GA client ID
+        url_params.append({
+            'referrer': 'gaid_referrer',
+            'key': 'ga_client_id',
+            'value': client_id,
+            'flag': segment_id,
+        })
+        return url_params
+
+    def __make_api_url(
+        self,
+        url_param: dict,
+    ) -> str:
+        """make measurement url."""
+        return self.api_url_fmt % (
+            url_param['referrer'],
+            url_param['key'],
+            urllib.parse.quote(url_param['value']),
+            urllib.parse.quote(url_param['flag']),
+        )
+
+    async def send_row_async(
+        self,
+        session: aiohttp.ClientSession,
+        segment_id: str,
+        client_id: str,
+        idfa: str,
+        adid: str,
+    ) -> bool:
+        """post measurement urls of one row asynchronously."""
+        for url_param in self.__make_url_params(
+            segment_id,
+            client_id,
+            idfa,
+            adid,
+        ):
+            await self.send_api_async(session, url_param)
+        return True
 
     def send_api(
         self,
@@ -90,13 +245,9 @@ class ExportBqDataToY(object):
         """post measurement url."""
         try:
             # request
-            api_url = self.api_url_fmt % (
-                url_param['referrer'],
-                url_param['key'],
-                urllib.parse.quote(url_param['value']),
-                urllib.parse.quote(url_param['flag']),
-            )
-            '''
+            api_url = self.__make_api_url(url_param)
+            if not self.send_beacon:
+                return True
             request = urllib.request.Request(api_url)
             response = urlopen(request)
             # check response code
@@ -106,47 +257,191 @@ class ExportBqDataToY(object):
                     response_code, api_url,
                 )
                 raise CommonError(msg)
-            '''
         except Exception as e:
-            msg = 'msg:%s, url param:%s.' % (e, api_url)
+            msg = 'msg:%s, url param:%s.' % (e, url_param)
             raise CommonError(msg)
         return True
 
-
-    def send_api(
+    async def send_api_async(
         self,
+        session: aiohttp.ClientSession,
         url_param: dict,
     ) -> bool:
-        """post measurement url."""
+        """post measurement url asynchronously."""
         try:
             # request
-            api_url = self.api_url_fmt % (
-                url_param['referrer'],
-                url_param['key'],
-                urllib.parse.quote(url_param['value']),
-                urllib.parse.quote(url_param['flag']),
-            )
-            '''
-            request = urllib.request.Request(api_url)
-            response = urlopen(request)
-            # check response code
-            response_code = response.getcode()
-            if response_code != 200:
-                msg = 'response code:%d, url:%s.' % (
-                    response_code, api_url,
-                )
-                raise CommonError(msg)
-            '''
+            api_url = self.__make_api_url(url_param)
+            if not self.send_beacon:
+                return True
+            async with session.get(api_url) as response:
+                # check response code
+                if response.status != 200:
+                    msg = 'response code:%d, url:%s.' % (
+                        response.status, api_url,
+                    )
+                    raise CommonError(msg)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            msg = 'msg:%s, url param:%s.' % (e, api_url)
+            msg = 'msg:%s, url param:%s.' % (e, url_param)
             raise CommonError(msg)
         return True
 
 
-def bq_to_yahoo(
+def get_env_number(
+        name: str,
+        default: str,
+        convert,
+        allow_zero: bool = False,
+):
+    """get positive number from environment variable."""
+    value = os.environ.get(name, default)
+    try:
+        number = convert(value)
+    except ValueError:
+        raise CommonError('%s must be a number: %s.' % (name, value))
+    if not (number > 0 or (allow_zero and number == 0)):
+        raise CommonError('%s must be positive: %s.' % (name, value))
+    return number
+
+
+async def send_bq_batches_async(
+        ebty: ExportBqDataToY,
+        session: aiohttp.ClientSession,
+        bq_batches,
+        bq_executor: concurrent.futures.Executor,
+        max_in_flight: int,
+        cloud_logger: logging.Logger,
+        error_reporting_client: error_reporting.Client,
+) -> tuple:
+    """send BigQuery batches by API asynchronously.
+
+    Up to max_in_flight rows are sent concurrently. Batches are fetched in
+    bq_executor, so BigQuery paging does not block the event loop.
+    On error, timeout or cancellation all pending sends are cancelled.
+    """
+    if not max_in_flight > 0:
+        raise CommonError('max_in_flight must be positive: %s.' % (
+            max_in_flight,
+        ))
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_in_flight)
+    tasks = set()
+    send_count = {'total': 0, 'success': 0}
+
+    async def send_row(
+            segment_id: str,
+            client_id: str,
+            idfa: str,
+            adid: str,
+    ):
+        """send one row."""
+        try:
+            await ebty.send_row_async(
+                session,
+                segment_id,
+                client_id,
+                idfa,
+                adid,
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            msg = '%s: %s.' % (__file__, e)
+            cloud_logger.error(msg)
+            await loop.run_in_executor(
+                None,
+                error_reporting_client.report,
+                msg,
+            )
+        else:
+            send_count['success'] += 1
+
+    def send_done(task: asyncio.Task):
+        """release slot of finished send."""
+        tasks.discard(task)
+        semaphore.release()
+
+    try:
+        while True:
+            bq_batch = await loop.run_in_executor(
+                bq_executor,
+                next,
+                bq_batches,
+                None,
+            )
+            if bq_batch is None:
+                break
+            send_count['total'] += len(bq_batch)
+            for segment_id, client_id, idfa, adid in bq_batch:
+                await semaphore.acquire()
+                task = loop.create_task(
+                    send_row(segment_id, client_id, idfa, adid),
+                )
+                tasks.add(task)
+                task.add_done_callback(send_done)
+        await asyncio.gather(*tasks)
+    finally:
+        # cancel pending sends
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return send_count['total'], send_count['success']
+
+
+async def export_bq_data_async(
+        ebty: ExportBqDataToY,
+        bq_query: str,
+        batch_size: int,
+        max_in_flight: int,
+        max_connections: int,
+        request_timeout: float,
+        cloud_logger: logging.Logger,
+        error_reporting_client: error_reporting.Client,
+) -> tuple:
+    """get data from BigQuery and send it by API asynchronously.
+
+    BigQuery calls run in a dedicated single thread executor. It is not
+    waited for on exit, so a hanging page fetch cannot block the return
+    after a timeout or cancellation.
+    """
+    loop = asyncio.get_running_loop()
+    bq_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        # get data from BigQuery
+        bq_batches = await loop.run_in_executor(
+            bq_executor,
+            ebty.get_data_batches_from_bq,
+            bq_query,
+            batch_size,
+        )
+        try:
+            # send data by API
+            async with aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=max_connections),
+                timeout=aiohttp.ClientTimeout(total=request_timeout),
+            ) as session:
+                return await send_bq_batches_async(
+                    ebty,
+                    session,
+                    bq_batches,
+                    bq_executor,
+                    max_in_flight,
+                    cloud_logger,
+                    error_reporting_client,
+                )
+        finally:
+            # close generator after a page fetch still in progress
+            bq_executor.submit(bq_batches.close)
+    finally:
+        bq_executor.shutdown(wait=False)
+
+
+async def bq_to_yahoo_async(
         event: dict,
         content,
 ) -> bool:
+    """export data from BigQuery to Yahoo! asynchronously."""
     # logging
     logging_client = google.cloud.logging.Client()
     handler = CloudLoggingHandler(logging_client)
@@ -157,7 +452,8 @@ def bq_to_yahoo(
     error_reporting_client = error_reporting.Client()
 
     # start
-    func_name = sys._getframe().f_code.co_name
+    # keep the public entry point name in logs
+    func_name = bq_to_yahoo.__name__
     cloud_logger.info('%s start.' % (func_name))
 
     # environmet variable
@@ -176,60 +472,54 @@ def bq_to_yahoo(
         start_date=start_date,
         end_date=end_date,
     )
+    # request measurement urls to Yahoo!
+    send_beacon = os.environ.get('send_beacon', 'false') == 'true'
+    # low memory mode: stream rows from BigQuery in compact batches
+    low_memory_mode = os.environ.get('low_memory_mode', 'false') == 'true'
 
+    loop = asyncio.get_running_loop()
 
     try:
-        success_count = 0
+        # numeric settings
+        batch_size = None
+        if low_memory_mode:
+            batch_size = get_env_number('batch_size', '1000', int)
+        # concurrency: in-flight rows, HTTP connections and timeouts (seconds)
+        max_in_flight = get_env_number('max_in_flight', '1000', int)
+        max_connections = get_env_number('max_connections', '100', int)
+        request_timeout = get_env_number('request_timeout', '10', float)
+        timeout = get_env_number('timeout', '0', float, True) or None
+
         # create model
         ebty = ExportBqDataToY(
             project_id,
             bq_dataset_id,
+            send_beacon,
         )
-        # get data from BigQuery
-        bq_data = ebty.get_data_from_bq(bq_query)
-
-        bq_data_length = len(list(bq_data))
-
-        # send data by API
-        for row in bq_data:
-            url_param_idfa = {}
-            url_param_adid = {}
-            url_param_gclid = {}
-            try:
-                if row.idfa != '':
-                    # IDFA
-                    url_param_idfa['referrer'] = 'idfa_referrer'
-                    url_param_idfa['key'] = 'idfa'
-                    url_param_idfa['value'] = row.idfa
-                    url_param_idfa['flag'] = str(row.segmentId)
-                    ebty.send_api(url_param_idfa)
-                if row.adid != '':
-                    # AAID
-                    url_param_adid['referrer'] = 'adid_referrer'
-                    url_param_adid['key'] = 'adid'
-                    url_param_adid['value'] = row.adid
-                    url_param_adid['flag'] = str(row.segmentId)
-                    ebty.send_api(url_param_adid)
-                # GA client ID
-                url_param_gclid['referrer'] = 'gaid_referrer'
-                url_param_gclid['key'] = 'ga_client_id'
-                url_param_gclid['value'] = row.clientId
-                url_param_gclid['flag'] = str(row.segmentId)
-                ebty.send_api(url_param_gclid)
-            except Exception as e:
-                msg = '%s: %s.' % (__file__, e)
-                cloud_logger.error(msg)
-                error_reporting_client.report(msg)
-                continue
-            else:
-                success_count += 1
-            # wait
-            sleep(0.01)
+        # get data from BigQuery and send data by API
+        try:
+            bq_data_length, success_count = await asyncio.wait_for(
+                export_bq_data_async(
+                    ebty,
+                    bq_query,
+                    batch_size,
+                    max_in_flight,
+                    max_connections,
+                    request_timeout,
+                    cloud_logger,
+                    error_reporting_client,
+                ),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            raise CommonError('timeout:%s seconds' % (timeout))
 
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
         msg = '%s: %s.' % (__file__, e)
         cloud_logger.error(msg)
-        error_reporting_client.report(msg)
+        await loop.run_in_executor(None, error_reporting_client.report, msg)
         return False
 
     # end
@@ -241,6 +531,12 @@ def bq_to_yahoo(
     return True
 
 
+def bq_to_yahoo(
+        event: dict,
+        content,
+) -> bool:
+    """export data from BigQuery to Yahoo!."""
+    return asyncio.run(bq_to_yahoo_async(event, content))
 
 
 if __name__ == '__main__':
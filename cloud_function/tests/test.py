@@ -2,16 +2,119 @@
 # -*- coding: UTF-8 -*-
 """Export data from BigQuery to Yahoo."""
 from google.cloud import bigquery
+import asyncio
+import concurrent.futures
+import itertools
 import os
 import sys
+import threading
+import time
+import tracemalloc
 import unittest
 from unittest import mock
 
 try:
     import main
+    import main_test
 except ImportError:
     sys.path.append(os.path.abspath(os.path.dirname(__file__)) + '/../')
     import main
+    import main_test
+
+
+class DummyRow(object):
+    """dummy BigQuery row."""
+    def __init__(
+        self,
+        segment_id: int,
+        client_id: str,
+        idfa: str,
+        adid: str,
+    ):
+        """init."""
+        self.segmentId = segment_id
+        self.clientId = client_id
+        self.idfa = idfa
+        self.adid = adid
+
+
+class DummyResponse(object):
+    """dummy HTTP response."""
+    def __init__(
+        self,
+        status: int,
+        wait: float,
+    ):
+        """init."""
+        self.status = status
+        self.wait = wait
+
+    async def __aenter__(self):
+        """enter."""
+        await asyncio.sleep(self.wait)
+        return self
+
+    async def __aexit__(self, *args):
+        """exit."""
+        return False
+
+
+class DummySession(object):
+    """dummy HTTP session."""
+    def __init__(
+        self,
+        status: int = 200,
+        wait: float = 0,
+    ):
+        """init."""
+        self.status = status
+        self.wait = wait
+        self.urls = []
+
+    async def __aenter__(self):
+        """enter."""
+        return self
+
+    async def __aexit__(self, *args):
+        """exit."""
+        return False
+
+    def get(
+        self,
+        url: str,
+    ) -> DummyResponse:
+        """get."""
+        self.urls.append(url)
+        return DummyResponse(self.status, self.wait)
+
+
+class CountingSession(DummySession):
+    """dummy HTTP session counting requests only."""
+    def __init__(self):
+        """init."""
+        super().__init__()
+        self.count = 0
+
+    def get(
+        self,
+        url: str,
+    ) -> DummyResponse:
+        """get."""
+        self.count += 1
+        return DummyResponse(self.status, self.wait)
+
+
+def make_dummy_rows(
+    row_count: int,
+):
+    """make dummy rows lazily."""
+    for i in range(row_count):
+        yield DummyRow(
+            i % 10,
+            '%010d.%010d' % (i, i),
+            '%036d' % i,
+            '%036d' % i,
+        )
 
 
 class ExportBqDataToYTests(unittest.TestCase):
@@ -58,4 +161,478 @@ class ExportBqDataToYTests(unittest.TestCase):
             side_effect=ValueError,
         ):
             with self.assertRaises(main.CommonError):
-                self.egtb.get_conf_data_from_gcs(conf_file_name)
\ No newline at end of file
+                self.egtb.get_conf_data_from_gcs(conf_file_name)
+
+
+class ExportBqDataToYBatchTests(unittest.TestCase):
+    """Export data from BigQuery to Yahoo in low memory mode."""
+    def setUp(self):
+        """set up."""
+        self.bq_project_id = 'test_bq_project_id'
+        self.bq_dataset_id = 'test_bq_dataset_id'
+        # create model
+        self.ebty = main_test.ExportBqDataToY(
+            self.bq_project_id,
+            self.bq_dataset_id,
+        )
+        self.ebty.bigquery_client = ''
+        self.ebty.bq_dataset = ''
+
+    def make_query_job(
+        self,
+        row_count: int,
+    ):
+        """make dummy query job."""
+        query_job = mock.Mock()
+        query_job.result.side_effect = (
+            lambda page_size: make_dummy_rows(row_count)
+        )
+        return query_job
+
+    def test_row_batch(self):
+        """row batch."""
+        rows = [
+            DummyRow(1, 'client_1', 'idfa_1', ''),
+            DummyRow(1, 'client_2', '', 'adid_2'),
+        ]
+        batch = main_test.RowBatch(rows)
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(list(batch), [
+            ('1', 'client_1', 'idfa_1', ''),
+            ('1', 'client_2', '', 'adid_2'),
+        ])
+        # same segment id shares one object
+        self.assertIs(batch.segment_ids[0], batch.segment_ids[1])
+
+    def test_get_data_batches_from_bq(self):
+        """get data batches from BigQuery."""
+        # positive
+        with mock.patch.object(
+            self.ebty,
+            '_ExportBqDataToY__bq_query',
+            return_value=self.make_query_job(2500),
+        ):
+            batches = list(self.ebty.get_data_batches_from_bq('query', 1000))
+            self.assertEqual([len(b) for b in batches], [1000, 1000, 500])
+        # negative
+        with mock.patch.object(
+            self.ebty,
+            '_ExportBqDataToY__bq_query',
+            return_value=self.make_query_job(0),
+        ):
+            with self.assertRaises(main_test.CommonError):
+                list(self.ebty.get_data_batches_from_bq('query', 1000))
+        with mock.patch.object(
+            self.ebty,
+            '_ExportBqDataToY__bq_query',
+            return_value=None,
+            side_effect=ValueError,
+        ):
+            with self.assertRaises(main_test.CommonError):
+                self.ebty.get_data_batches_from_bq('query', 1000)
+        # negative: invalid batch_size
+        with self.assertRaises(main_test.CommonError):
+            self.ebty.get_data_batches_from_bq('query', 0)
+        # negative: next page fetch fails
+        query_job = mock.Mock()
+        query_job.result.return_value = itertools.chain(
+            make_dummy_rows(1500),
+            map(int, ['error']),
+        )
+        with mock.patch.object(
+            self.ebty,
+            '_ExportBqDataToY__bq_query',
+            return_value=query_job,
+        ):
+            batches = self.ebty.get_data_batches_from_bq('query', 1000)
+            self.assertEqual(len(next(batches)), 1000)
+            with self.assertRaises(main_test.CommonError):
+                next(batches)
+
+    def test_low_memory_mode_memory(self):
+        """memory ceiling of low memory mode.
+
+        peak memory of batching and sending dummy rows must stay under
+        8 MiB with batch_size 1000 and max_in_flight 1000, and must not
+        grow with the result size.
+        """
+        memory_ceiling = 8 * 1024 * 1024
+        self.ebty.send_beacon = True
+        peaks = []
+        for row_count in [10000, 30000]:
+            session = CountingSession()
+            bq_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1,
+            )
+            with mock.patch.object(
+                self.ebty,
+                '_ExportBqDataToY__bq_query',
+                return_value=self.make_query_job(row_count),
+            ):
+                bq_batches = self.ebty.get_data_batches_from_bq(
+                    'query',
+                    1000,
+                )
+                tracemalloc.start()
+                try:
+                    send_count = asyncio.run(
+                        main_test.send_bq_batches_async(
+                            self.ebty,
+                            session,
+                            bq_batches,
+                            bq_executor,
+                            1000,
+                            mock.Mock(),
+                            mock.Mock(),
+                        ),
+                    )
+                    _, peak = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+                    bq_executor.shutdown()
+            self.assertEqual(send_count, (row_count, row_count))
+            self.assertEqual(session.count, row_count * 3)
+            self.assertLess(peak, memory_ceiling)
+            peaks.append(peak)
+        # unbatched data grows about 2x from 10000 to 30000 rows
+        self.assertLess(peaks[1], peaks[0] * 1.5)
+
+
+class ExportBqDataToYAsyncTests(unittest.TestCase):
+    """Export data from BigQuery to Yahoo asynchronously."""
+    def setUp(self):
+        """set up."""
+        self.bq_project_id = 'test_bq_project_id'
+        self.bq_dataset_id = 'test_bq_dataset_id'
+        # create model
+        self.ebty = main_test.ExportBqDataToY(
+            self.bq_project_id,
+            self.bq_dataset_id,
+            True,
+        )
+        self.ebty.bigquery_client = ''
+        self.ebty.bq_dataset = ''
+        self.bq_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1,
+        )
+        self.url_param = {
+            'referrer': 'idfa_referrer',
+            'key': 'idfa',
+            'value': 'idfa_1',
+            'flag': '1',
+        }
+
+    def tearDown(self):
+        """tear down."""
+        self.bq_executor.shutdown()
+
+    def test_send_api(self):
+        """send api."""
+        api_url = self.ebty.api_url_fmt % (
+            'idfa_referrer',
+            'idfa',
+            'idfa_1',
+            '1',
+        )
+        # positive
+        with mock.patch.object(main_test, 'urlopen') as urlopen:
+            urlopen.return_value.getcode.return_value = 200
+            self.assertTrue(self.ebty.send_api(self.url_param))
+            self.assertEqual(urlopen.call_args[0][0].full_url, api_url)
+        # positive: send_beacon is off
+        self.ebty.send_beacon = False
+        with mock.patch.object(main_test, 'urlopen') as urlopen:
+            self.assertTrue(self.ebty.send_api(self.url_param))
+            urlopen.assert_not_called()
+        self.ebty.send_beacon = True
+        # negative
+        with mock.patch.object(main_test, 'urlopen') as urlopen:
+            urlopen.return_value.getcode.return_value = 500
+            with self.assertRaises(main_test.CommonError):
+                self.ebty.send_api(self.url_param)
+        with mock.patch.object(
+            main_test,
+            'urlopen',
+            side_effect=ValueError,
+        ):
+            with self.assertRaises(main_test.CommonError):
+                self.ebty.send_api(self.url_param)
+
+    def test_send_api_async(self):
+        """send api asynchronously."""
+        # positive
+        session = DummySession()
+        self.assertTrue(asyncio.run(
+            self.ebty.send_api_async(session, self.url_param),
+        ))
+        self.assertEqual(session.urls, [
+            self.ebty.api_url_fmt % ('idfa_referrer', 'idfa', 'idfa_1', '1'),
+        ])
+        # positive: send_beacon is off
+        session = DummySession()
+        self.ebty.send_beacon = False
+        self.assertTrue(asyncio.run(
+            self.ebty.send_api_async(session, self.url_param),
+        ))
+        self.assertEqual(session.urls, [])
+        self.ebty.send_beacon = True
+        # negative
+        with self.assertRaises(main_test.CommonError):
+            asyncio.run(self.ebty.send_api_async(
+                DummySession(status=500),
+                self.url_param,
+            ))
+        # cancel
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(asyncio.wait_for(
+                self.ebty.send_api_async(
+                    DummySession(wait=10),
+                    self.url_param,
+                ),
+                0.01,
+            ))
+
+    def test_send_row_async(self):
+        """send row asynchronously."""
+        session = DummySession()
+        self.assertTrue(asyncio.run(self.ebty.send_row_async(
+            session,
+            '1',
+            'client_1',
+            '',
+            'adid_1',
+        )))
+        self.assertEqual(len(session.urls), 2)
+
+    def test_send_bq_batches_async(self):
+        """send BigQuery batches asynchronously."""
+        batches = [
+            main_test.RowBatch(make_dummy_rows(1000)),
+            main_test.RowBatch(make_dummy_rows(500)),
+        ]
+        # positive: rows are sent concurrently
+        session = DummySession(wait=0.1)
+        self.assertEqual(
+            asyncio.run(asyncio.wait_for(
+                main_test.send_bq_batches_async(
+                    self.ebty,
+                    session,
+                    iter(batches),
+                    self.bq_executor,
+                    1000,
+                    mock.Mock(),
+                    mock.Mock(),
+                ),
+                5,
+            )),
+            (1500, 1500),
+        )
+        self.assertEqual(len(session.urls), 1500 * 3)
+        # negative: failed rows are reported
+        cloud_logger = mock.Mock()
+        self.assertEqual(
+            asyncio.run(main_test.send_bq_batches_async(
+                self.ebty,
+                DummySession(status=500),
+                iter(batches[1:]),
+                self.bq_executor,
+                100,
+                cloud_logger,
+                mock.Mock(),
+            )),
+            (500, 0),
+        )
+        self.assertEqual(cloud_logger.error.call_count, 500)
+        # negative: max_in_flight must be positive
+        with self.assertRaises(main_test.CommonError):
+            asyncio.run(main_test.send_bq_batches_async(
+                self.ebty,
+                DummySession(),
+                iter(batches),
+                self.bq_executor,
+                0,
+                mock.Mock(),
+                mock.Mock(),
+            ))
+        # timeout: pending sends are cancelled
+        session = DummySession(wait=10)
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(asyncio.wait_for(
+                main_test.send_bq_batches_async(
+                    self.ebty,
+                    session,
+                    iter(batches),
+                    self.bq_executor,
+                    100,
+                    mock.Mock(),
+                    mock.Mock(),
+                ),
+                0.1,
+            ))
+        self.assertEqual(len(session.urls), 100)
+
+
+class BqToYahooTests(unittest.TestCase):
+    """entry point."""
+    def setUp(self):
+        """set up."""
+        self.env = {
+            'send_beacon': 'true',
+            'low_memory_mode': 'false',
+            'batch_size': '7',
+            'timeout': '0',
+        }
+        self.query_threads = []
+        self.cloud_logger = mock.Mock()
+
+    def make_query_job(
+        self,
+        rows,
+    ):
+        """make dummy query job."""
+        query_job = mock.Mock()
+        query_job.result.side_effect = lambda page_size: rows
+        return query_job
+
+    def run_bq_to_yahoo(
+        self,
+        query_job,
+        session: DummySession,
+    ) -> bool:
+        """run entry point with dummy clients."""
+        def bq_query(query):
+            """dummy query."""
+            self.query_threads.append(threading.current_thread())
+            return query_job
+        with mock.patch.dict(os.environ, self.env), \
+                mock.patch('google.cloud.logging.Client'), \
+                mock.patch.object(main_test, 'CloudLoggingHandler'), \
+                mock.patch.object(
+                    main_test.logging,
+                    'getLogger',
+                    return_value=self.cloud_logger,
+                ), \
+                mock.patch.object(main_test.error_reporting, 'Client'), \
+                mock.patch.object(main_test.bigquery, 'Client'), \
+                mock.patch.object(
+                    main_test.ExportBqDataToY,
+                    '_ExportBqDataToY__bq_query',
+                    side_effect=bq_query,
+                ), \
+                mock.patch.object(main_test.aiohttp, 'TCPConnector'), \
+                mock.patch.object(
+                    main_test.aiohttp,
+                    'ClientSession',
+                    return_value=session,
+                ):
+            return main_test.bq_to_yahoo({'data': 'test'}, None)
+
+    def test_bq_to_yahoo(self):
+        """send all rows."""
+        query_job = self.make_query_job(make_dummy_rows(20))
+        session = DummySession()
+        self.assertTrue(self.run_bq_to_yahoo(query_job, session))
+        query_job.result.assert_called_once_with(page_size=None)
+        self.assertEqual(len(session.urls), 20 * 3)
+        self.assertEqual(self.cloud_logger.info.call_args_list, [
+            mock.call('bq_to_yahoo start.'),
+            mock.call('total send count:20, success send count:20.'),
+            mock.call('bq_to_yahoo end.'),
+        ])
+        # query runs in executor
+        self.assertIsNot(self.query_threads[0], threading.main_thread())
+
+    def test_bq_to_yahoo_low_memory_mode(self):
+        """send all rows in low memory mode."""
+        self.env['low_memory_mode'] = 'true'
+        query_job = self.make_query_job(make_dummy_rows(20))
+        session = DummySession()
+        self.assertTrue(self.run_bq_to_yahoo(query_job, session))
+        query_job.result.assert_called_once_with(page_size=7)
+        self.assertEqual(len(session.urls), 20 * 3)
+        self.cloud_logger.info.assert_any_call(
+            'total send count:20, success send count:20.',
+        )
+
+    def test_bq_to_yahoo_no_send_beacon(self):
+        """no request without send_beacon."""
+        self.env['send_beacon'] = 'false'
+        session = DummySession()
+        self.assertTrue(self.run_bq_to_yahoo(
+            self.make_query_job(make_dummy_rows(20)),
+            session,
+        ))
+        self.assertEqual(session.urls, [])
+
+    def test_bq_to_yahoo_timeout(self):
+        """timeout."""
+        self.env['timeout'] = '0.1'
+        # send hangs
+        self.assertFalse(self.run_bq_to_yahoo(
+            self.make_query_job(make_dummy_rows(20)),
+            DummySession(wait=10),
+        ))
+        self.assertIn('timeout', self.cloud_logger.error.call_args[0][0])
+
+        # page fetch hangs
+        def hanging_rows():
+            """dummy rows of a hanging page fetch."""
+            time.sleep(1)
+            yield from make_dummy_rows(20)
+        self.env['low_memory_mode'] = 'true'
+        start = time.time()
+        self.assertFalse(self.run_bq_to_yahoo(
+            self.make_query_job(hanging_rows()),
+            DummySession(),
+        ))
+        self.assertLess(time.time() - start, 1)
+
+    def test_bq_to_yahoo_invalid_batch_size(self):
+        """invalid batch_size."""
+        self.env['low_memory_mode'] = 'true'
+        for batch_size in ['abc', '0', '-1']:
+            self.env['batch_size'] = batch_size
+            query_job = self.make_query_job(make_dummy_rows(20))
+            self.assertFalse(self.run_bq_to_yahoo(query_job, DummySession()))
+            self.assertIn(
+                'batch_size',
+                self.cloud_logger.error.call_args[0][0],
+            )
+            query_job.result.assert_not_called()
+
+    def test_bq_to_yahoo_invalid_setting(self):
+        """invalid concurrency and timeout settings."""
+        invalid_settings = [
+            ('max_in_flight', ['abc', '0', '-1']),
+            ('max_connections', ['abc', '0', '-1']),
+            ('request_timeout', ['abc', '0', '-1', 'nan']),
+            ('timeout', ['abc', '-1', 'nan']),
+        ]
+        for name, values in invalid_settings:
+            for value in values:
+                self.env = dict(self.env, **{name: value})
+                query_job = self.make_query_job(make_dummy_rows(20))
+                # must not hang
+                with concurrent.futures.ThreadPoolExecutor() as executor:
+                    result = executor.submit(
+                        self.run_bq_to_yahoo,
+                        query_job,
+                        DummySession(),
+                    ).result(timeout=5)
+                self.assertFalse(result)
+                self.assertIn(name, self.cloud_logger.error.call_args[0][0])
+                query_job.result.assert_not_called()
+                self.setUp()
+
+    def test_bq_to_yahoo_no_data(self):
+        """no data in BigQuery."""
+        for low_memory_mode in ['false', 'true']:
+            self.env['low_memory_mode'] = low_memory_mode
+            self.assertFalse(self.run_bq_to_yahoo(
+                self.make_query_job(make_dummy_rows(0)),
+                DummySession(),
+            ))
+            self.assertIn(
+                'no data in BigQuery.',
+                self.cloud_logger.error.call_args[0][0],
+            )